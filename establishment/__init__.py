@@ -1,20 +1,30 @@
+import concurrent.futures
 import csv
+import io
 import itertools
+import os
+import pathlib
 import sqlite3
 import sys
-from typing import TYPE_CHECKING, Any, Generator, Iterable, TextIO, Union
+from typing import TYPE_CHECKING, Any, Callable, Generator, Iterable, TextIO, Union
 
 import tqdm
 import click
 import dedupe
+import numpy
 from dedupe._typing import ArrayLinks, BlocksInt, DataInt, LookupResultsInt, Record
 
 if TYPE_CHECKING:
-    import os
     from importlib.resources.abc import Traversable
 
     PathLike = Union[str, Traversable, os.PathLike]
 
+# The smallest host parameter limit SQLite has shipped with.
+SQLITE_MAX_VARIABLES = 999
+
+# Canonical records sent to each fingerprinting worker at a time.
+FINGERPRINT_CHUNK_SIZE = 10000
+
 
 class EstablishmentGazetteer(dedupe.StaticGazetteer):
     def __init__(
@@ -32,13 +42,67 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
         self.data_table_name = canonical_table_name
         self.entity_table_name = entity_table_name
 
+        # dict.fromkeys dedupes like a set, but keeps the order stable
+        # so the SQL built from these fields is the same every run.
         self.primary_fields = tuple(
-            {var.field for var in self.data_model.primary_variables}
+            dict.fromkeys(var.field for var in self.data_model.primary_variables)
+        )
+        self._blocked_fields = tuple(
+            dict.fromkeys(
+                simplepred.field
+                for predicate in self.predicates
+                for simplepred in predicate
+            )
         )
 
+        # The table and column names are fixed for the life of the
+        # gazetteer, so build the query text once and let sqlite3's
+        # statement cache reuse the compiled statements.
+        self._pairs_sql = """
+            SELECT
+                a.record_id AS record_id_a,
+                b.record_id AS record_id_b,
+                {columns}
+            FROM
+                blocking_map a
+                INNER JOIN indexed_records b USING (block_key)
+                INNER JOIN {data_table} AS dt ON b.record_id = dt.id
+            ORDER BY
+                a.record_id,
+                b.record_id
+            """.format(
+            data_table=self.data_table_name,
+            columns=", ".join("dt." + field for field in self.primary_fields),
+        )
+        self._entity_sql = """
+            SELECT
+                entity_id,
+                dt.*
+            FROM
+                {entity_map}
+                INNER JOIN {data_table} dt USING (id)
+            WHERE
+                id IN ({{placeholders}})
+            """.format(
+            entity_map=self.entity_table_name, data_table=self.data_table_name
+        )
+        self._entity_sql_by_size: dict[int, str] = {}
+        self._canonical_sql = """
+            SELECT
+                id,
+                {fields}
+            FROM
+                {data_table}
+            """.format(
+            fields=", ".join(self._blocked_fields), data_table=self.data_table_name
+        )
+
+        # One long-lived connection serves the lookups and reads outside
+        # of blocks(), which opens its own for each call.
+        self._con = self._connect()
+
         # Check if indexed_records table exists and create it not.
-        con = sqlite3.connect(self.db)
-        (indexed_records_exists,) = con.execute(
+        (indexed_records_exists,) = self._con.execute(
             """
             SELECT
                 EXISTS (
@@ -96,61 +160,91 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
             ]
         """
 
-        con = sqlite3.connect(self.db, check_same_thread=False)
-        con.row_factory = sqlite3.Row
+        # Each call gets its own connection, so that a blocks()
+        # generator that is still suspended, or abandoned in a dedupe
+        # worker thread, can't hold a transaction that a later call
+        # needs to start.
+        con = self._connect()
 
+        # The blocking map only lives for this transaction, which is
+        # always rolled back, even if the caller stops iterating early.
         con.execute("BEGIN")
 
-        con.execute(
-            """
-            CREATE TEMPORARY TABLE blocking_map (
-                block_key text,
-                record_id integer)
-            """
-        )
-        con.executemany(
-            """
-            INSERT INTO blocking_map
-                VALUES (?, ?)
-            """,
-            self.fingerprinter(data.items()),
-        )
-
-        pairs = con.execute(
-            """
-            SELECT DISTINCT
-                a.record_id AS record_id_a,
-                b.record_id AS record_id_b,
-                {columns}
-            FROM
-                blocking_map a
-                INNER JOIN indexed_records b USING (block_key)
-                INNER JOIN {data_table} AS dt ON b.record_id = id
-            ORDER BY
-                a.record_id
-            """.format(
-                data_table=self.data_table_name, columns=", ".join(self.primary_fields)
+        try:
+            con.execute(
+                """
+                CREATE TEMPORARY TABLE blocking_map (
+                    block_key text,
+                    record_id integer)
+                """
+            )
+            con.executemany(
+                """
+                INSERT INTO blocking_map
+                    VALUES (?, ?)
+                """,
+                self.fingerprinter(data.items()),
             )
-        )
 
-        pair_blocks: Iterable[tuple[int, Iterable[sqlite3.Row]]] = itertools.groupby(
-            pairs, lambda x: x["record_id_a"]
+            # Pairs that share more than one block key come back more than
+            # once. Ordering on both ids makes the repeats adjacent, so we
+            # drop them while grouping rather than with DISTINCT. SQLite
+            # still sorts the join for the ORDER BY.
+            #
+            # Rows are (record_id_a, record_id_b, *primary_fields), and
+            # come back grouped by record_id_a, so a block ends whenever
+            # record_id_a changes.
+            #
+            # The canonical fields are lowercased once, when the
+            # gazetteer database is built (see whd.csv in the Makefile),
+            # so they go to the scorer exactly as they are stored.
+            pairs = con.execute(self._pairs_sql)
+            primary_fields = self.primary_fields
+
+            block: list = []
+            a_record_id = a_record = last_b_record_id = None
+            for row in pairs:
+                if row[0] != a_record_id:
+                    if block:
+                        yield block
+                    block = []
+                    a_record_id = row[0]
+                    a_record = data[a_record_id]
+                    last_b_record_id = None
+
+                b_record_id = row[1]
+                if b_record_id == last_b_record_id:
+                    continue
+                last_b_record_id = b_record_id
+
+                b_record = dict(zip(primary_fields, row[2:]))
+                block.append(((a_record_id, a_record), (b_record_id, b_record)))
+
+            if block:
+                yield block
+
+            pairs.close()
+        finally:
+            con.execute("ROLLBACK")
+            con.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a read-only connection to the gazetteer database. blocks()
+        may be driven from a dedupe worker thread, hence
+        check_same_thread. Read-only, rather than query_only, still lets
+        blocks() build its temporary tables. The database is mapped into
+        memory, so page reads don't need a read() and a copy.
+        """
+        con = sqlite3.connect(
+            pathlib.Path(self.db).absolute().as_uri() + "?mode=ro",
+            uri=True,
+            check_same_thread=False,
         )
-
-        for a_record_id, pair_block in pair_blocks:
-            a_record = data[a_record_id]
-
-            yield [
-                (
-                    (a_record_id, a_record),
-                    (row["record_id_b"], dict(row)),
-                )
-                for row in pair_block
-            ]
-
-        pairs.close()
-        con.execute("ROLLBACK")
-        con.close()
+        con.execute("pragma cache_size=-524288")
+        con.execute("pragma mmap_size=2147483648")
+        con.execute("pragma temp_store=memory")
+        return con
 
     def search(  # type: ignore[override]
         self,
@@ -205,43 +299,41 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
         yield from results
 
     def _hydrate_matches(self, data: DataInt, results: ArrayLinks):
-        con = sqlite3.connect(self.db)
-        con.row_factory = sqlite3.Row
+        results = list(results)
+
+        # Look up every matched canonical record for the whole batch at
+        # once, in as few statements as SQLite's bound variable limit
+        # allows. The ids stay integers all the way to SQLite, and
+        # sorting them keeps each batch's primary key lookups close
+        # together.
+        entity_lookup = {}
+        ids: list[int] = []
+        if results:
+            ids = numpy.unique(
+                numpy.concatenate([result["pairs"][:, 1] for result in results])
+            ).tolist()
+        for i in range(0, len(ids), SQLITE_MAX_VARIABLES):
+            id_batch = ids[i : i + SQLITE_MAX_VARIABLES]
+            entity_relations = self._con.execute(
+                self._entity_query(len(id_batch)), id_batch
+            )
+            fieldnames = [column[0] for column in entity_relations.description]
+            id_index = fieldnames.index("id")
+            entity_lookup.update(
+                {row[id_index]: dict(zip(fieldnames, row)) for row in entity_relations}
+            )
 
         seen_messy = set()
 
         for result in results:
             a = None
 
-            canonical_ids = tuple(
-                str(identifier) for identifier in result["pairs"][:, 1]
-            )
-
-            entity_relations = con.execute(
-                """
-                SELECT
-                    entity_id,
-                    dt.*
-                FROM
-                    {entity_map}
-                    INNER JOIN {data_table} dt USING (id)
-                WHERE
-                    id IN ({ids})
-                """.format(
-                    entity_map=self.entity_table_name,
-                    data_table=self.data_table_name,
-                    ids=", ".join(canonical_ids),
-                )
-            )
-
-            entity_lookup = {row["id"]: dict(row) for row in entity_relations}
-
             seen_entities = set()
 
             prepared_result = []
 
             for (a, b), score in result:
-                canonical = entity_lookup[b]
+                canonical = entity_lookup[b].copy()
                 entity_id = canonical.pop("entity_id")
                 if entity_id not in seen_entities:
                     prepared_result.append((entity_id, b, canonical, score))
@@ -254,38 +346,94 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
         for k in data.keys() - seen_messy:
             yield ((k, data[k]), ())
 
+    def _entity_query(self, n_ids: int) -> str:
+        """
+        The entity lookup query with `n_ids` placeholders. Batches are
+        capped at SQLITE_MAX_VARIABLES, so this cache stays small.
+        """
+        try:
+            return self._entity_sql_by_size[n_ids]
+        except KeyError:
+            sql = self._entity_sql.format(placeholders=", ".join("?" * n_ids))
+            self._entity_sql_by_size[n_ids] = sql
+            return sql
+
     def __del__(self) -> None:
-        pass
+        if hasattr(self, "_con"):
+            self._con.close()
 
     def reblock_canonical(self) -> None:
-        con = sqlite3.connect(self.db)
-        con.row_factory = sqlite3.Row
-
-        blocked_fields = tuple(
-            {
-                simplepred.field
-                for predicate in self.predicates
-                for simplepred in predicate
-            }
-        )
+        blocked_fields = self._blocked_fields
 
+        # Rows are (id, *blocked_fields). The fingerprinter looks fields
+        # up by name many times per record, which is cheaper on a dict
+        # than on a sqlite3.Row.
         results = (
-            (row["id"], row)
-            for row in con.execute(
-                """
-                SELECT
-                    id,
-                    {fields}
-                FROM
-                    {data_table}
-                """.format(
-                    fields=", ".join(blocked_fields), data_table=self.data_table_name
-                )
-            )
+            (row[0], dict(zip(blocked_fields, row[1:])))
+            for row in self._con.execute(self._canonical_sql)
         )
 
         self.block_index(results, rebuild=True)
 
+    def _indexed_records_stats(
+        self, con: sqlite3.Connection
+    ) -> list[tuple[str, str, str]]:
+        """
+        The sqlite_stat1 rows for indexed_records, if it has been
+        analyzed. The first number in each row's stat is the row count.
+        """
+        (stats_exist,) = con.execute(
+            """
+            SELECT
+                EXISTS (
+                    SELECT
+                        name
+                    FROM
+                        sqlite_master
+                    WHERE
+                        TYPE = 'table'
+                        AND name = 'sqlite_stat1')
+            """
+        ).fetchone()
+
+        if not stats_exist:
+            return []
+
+        return con.execute(
+            """
+            SELECT
+                tbl,
+                idx,
+                stat
+            FROM
+                sqlite_stat1
+            WHERE
+                tbl = 'indexed_records'
+            """
+        ).fetchall()
+
+    def _parallel_fingerprints(
+        self, data: Iterable[Record]
+    ) -> Generator[tuple[str, int], None, None]:
+        """
+        Fingerprint records as index targets across `num_cores`
+        processes, yielding each chunk's block keys as it finishes.
+        """
+        records = iter(data)
+        chunks = iter(
+            lambda: list(itertools.islice(records, FINGERPRINT_CHUNK_SIZE)), []
+        )
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.num_cores,
+            initializer=_init_worker,
+            initargs=(dedupe.blocking.Fingerprinter, self.predicates),
+        ) as executor:
+            for fingerprints in _bounded_map(
+                executor, _fingerprint_chunk, chunks, 2 * self.num_cores
+            ):
+                yield from fingerprints
+
     def block_index(
         self, data: Iterable[Record], rebuild: bool = False
     ) -> None:  # pragma: no cover
@@ -300,14 +448,28 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
                   field_names
         """
 
+        # Writes get their own connection, so a rebuild can drop
+        # indexed_records while the gazetteer's connection is still
+        # streaming canonical records into it.
         con = sqlite3.connect(self.db)
 
+        # Set journal mode to WAL. A bulk load doesn't need a sync on
+        # every write, and the index build can sort in memory.
+        con.execute("pragma journal_mode=wal")
+        con.execute("pragma synchronous=normal")
+        con.execute("pragma temp_store=memory")
+
+        # Load the whole index in a single transaction, rather than
+        # paying for a commit per fingerprint.
+        con.execute("BEGIN IMMEDIATE")
+
+        # Dropping indexed_records also drops its statistics, so take a
+        # copy of them first.
+        previous_stats = self._indexed_records_stats(con)
+
         if rebuild:
             con.execute("DROP TABLE IF EXISTS indexed_records")
 
-        # Set journal mode to WAL.
-        con.execute("pragma journal_mode=wal")
-
         con.execute(
             """
             CREATE TABLE IF NOT EXISTS indexed_records (
@@ -317,12 +479,17 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
             """
         )
 
+        if self.num_cores > 1:
+            fingerprints = self._parallel_fingerprints(data)
+        else:
+            fingerprints = self.fingerprinter(data, target=True)
+
         con.executemany(
             """
             REPLACE INTO indexed_records
             VALUES (?, ?)
             """,
-            self.fingerprinter(data, target=True),
+            fingerprints,
         )
 
         con.execute(
@@ -331,17 +498,81 @@ class EstablishmentGazetteer(dedupe.StaticGazetteer):
                        ON indexed_records
                        (block_key, record_id)"""
         )
-        con.execute("""ANALYZE""")
 
-        con.commit()
+        # The canonical data rarely changes between builds, so only pay
+        # for a fresh ANALYZE when the index has grown or shrunk by more
+        # than a tenth. Otherwise, the old statistics are still good.
+        (n_indexed,) = con.execute("SELECT COUNT(*) FROM indexed_records").fetchone()
+        if not previous_stats:
+            con.execute("""ANALYZE""")
+        else:
+            n_previously_indexed = int(previous_stats[0][2].split()[0])
+            if abs(n_indexed - n_previously_indexed) > n_previously_indexed / 10:
+                con.execute("ANALYZE indexed_records")
+            elif rebuild:
+                con.executemany(
+                    "INSERT INTO sqlite_stat1 VALUES (?, ?, ?)", previous_stats
+                )
+
+        con.execute("COMMIT")
         con.close()
 
 
+# Each worker process builds its state, a fingerprinter or a
+# gazetteer, once in its pool initializer and reuses it for every task
+# it is sent.
+_worker_state: Any = None
+
+
+def _init_worker(build: Callable[..., Any], *args: Any) -> None:
+    global _worker_state
+
+    _worker_state = build(*args)
+
+
+def _bounded_map(
+    executor: concurrent.futures.Executor,
+    fn: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_pending: int,
+) -> Generator[Any, None, None]:
+    """
+    Like `executor.map`, but reads at most `max_pending` items ahead of
+    the workers, and yields results in the order they finish rather
+    than the order they were submitted.
+    """
+    pending: set[concurrent.futures.Future] = set()
+
+    for item in items:
+        pending.add(executor.submit(fn, item))
+
+        if len(pending) >= max_pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                yield future.result()
+
+    for future in concurrent.futures.as_completed(pending):
+        yield future.result()
+
+
+def _fingerprint_chunk(records: list[Record]) -> list[tuple[str, int]]:
+    assert isinstance(_worker_state, dedupe.blocking.Fingerprinter)
+
+    # Sorted, so each chunk goes into the index's b-tree in key order.
+    return sorted(_worker_state(records, target=True))
+
+
 def preProcess(column: str) -> Union[str, None]:
     """
     Do a little bit of data cleaning with the help of Unidecode and Regex.
     Things like casing, extra spaces, quotes and new lines can be ignored.
     """
+    # Already normalized values are common, and checking is cheaper
+    # than having lower() build a copy.
+    if column.islower():
+        return column
     column = column.lower()
     # If data is missing, indicate that by setting the value to `None`
     if not column:
@@ -350,50 +581,101 @@ def preProcess(column: str) -> Union[str, None]:
 
 
 def readData(
-    f: TextIO, identifier: str, chunk_size: int = 100
+    f: TextIO, identifier: str, chunk_size: int = 500
 ) -> Generator[dict[int, dict[str, Any]], None, None]:
     """
     Read in our data from a CSV file and create a dictionary of records,
     where the key is a unique record ID and each value is dict
     """
 
+    header = next(csv.reader(f), None)
+    if header is None:
+        return
+    identifier_index = header.index(identifier)
+
+    # Same cleaning as preProcess, but we lowercase each line before
+    # parsing it, rather than each field after.
+    reader = csv.reader(map(str.lower, f))
+
     data_d = {}
-    reader = csv.DictReader(f)
     for row in tqdm.tqdm(reader):
-        clean_row = [(k, preProcess(v)) for (k, v) in row.items()]
-        row_id = int(row[identifier])
-        data_d[row_id] = dict(clean_row)
+        if not row:
+            continue
 
-        if len(data_d) == chunk_size:
+        row_id = int(row[identifier_index])
+        data_d[row_id] = {k: v or None for k, v in zip(header, row)}
+
+        if len(data_d) >= chunk_size:
             yield data_d
             data_d = {}
 
+    if data_d:
+        yield data_d
+
+
+def _process_chunk(messy_records_chunk: dict[int, dict[str, Any]]) -> str:
+    """
+    Match a chunk of messy records and return the output rows for it,
+    already formatted as CSV. Formatting in the worker keeps that work
+    off the main process, which only has to write one string per chunk.
+    """
+    assert isinstance(_worker_state, EstablishmentGazetteer)
+
+    results = _worker_state.search(messy_records_chunk, n_matches=5)
+
+    rows = io.StringIO()
+    csv.writer(rows).writerows(
+        (messy_record_id, establishment_id, confidence)
+        for (messy_record_id, _), matches in results
+        for establishment_id, _, _, confidence in matches
+    )
+    return rows.getvalue()
+
 
 @click.command()
 @click.argument("infile", type=click.File("r"), nargs=1, default=sys.stdin)
 @click.argument("outfile", type=click.File("w"), nargs=1, default=sys.stdout)
 @click.option("--identifier", type=str, nargs=1)
-def main(infile: TextIO, outfile: TextIO, identifier: str):
+@click.option(
+    "--cores",
+    type=int,
+    default=None,
+    help="Number of processes to match with. Defaults to the number of CPUs.",
+)
+def main(infile: TextIO, outfile: TextIO, identifier: str, cores: Union[int, None]):
     from importlib.resources import files
 
     db_path = files("establishment").joinpath("gazetteer.db")
     settings_path = files("establishment").joinpath("learned_settings")
 
-    gazetteer = EstablishmentGazetteer(
-        db_path, "canonical", "entity_map", settings_path
-    )
+    # Build the gazetteer here first, so that if the canonical records
+    # need to be indexed, that happens once, before any workers start.
+    EstablishmentGazetteer(db_path, "canonical", "entity_map", settings_path)
 
     writer = csv.writer(outfile)
     writer.writerow([identifier, "establishment_identifier", "confidence"])
 
-    for messy_records_chunk in readData(infile, identifier, chunk_size=5000):
-        results = gazetteer.search(messy_records_chunk, n_matches=5, generator=False)
-
-        for messy_record, matches in results:
-            messy_record_id, rest = messy_record
-            for matched_record in matches:
-                establishment_id, _, _, confidence = matched_record
-                writer.writerow([messy_record_id, establishment_id, confidence])
+    cores = cores or os.cpu_count() or 1
+
+    # Chunks are already spread across processes, so don't let dedupe
+    # start a pool of its own for scoring in each worker.
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=cores,
+        initializer=_init_worker,
+        initargs=(
+            EstablishmentGazetteer,
+            db_path,
+            "canonical",
+            "entity_map",
+            settings_path,
+            1,
+        ),
+    ) as executor:
+        messy_records_chunks = readData(infile, identifier, chunk_size=5000)
+        for rows in _bounded_map(
+            executor, _process_chunk, messy_records_chunks, 2 * cores
+        ):
+            outfile.write(rows)
 
 
 if __name__ == "__main__":